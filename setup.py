@@ -32,7 +32,6 @@ setup(
     classifiers=[
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: GNU General Public License (GPL)',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
     ],
 )
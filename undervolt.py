@@ -5,19 +5,20 @@ Tool for undervolting Intel CPUs under Linux
 """
 
 import argparse
+import atexit
+import ctypes
+import fcntl
+import functools
 import logging
 import os
 import re
 import sys
-import multiprocessing
+from array import array
 from collections import namedtuple
 from glob import glob
-from struct import pack, unpack
+from operator import attrgetter
+from struct import Struct
 import subprocess
-try:  # Python3
-    import configparser
-except ImportError:  # Python2
-    import ConfigParser as configparser
 
 try: # Python >=3.3
     from math import log2
@@ -28,6 +29,9 @@ except ImportError:
 
 __version__ = '0.4.0'
 
+# precompiled 64-bit (un)packer, so the format string is parsed once
+_Q = Struct('<Q')
+
 AC_STATE_NODE = os.environ.get(
     'AC_STATE_NODE', (glob('/sys/class/power_supply/AC*/online') + [None])[0])
 PLANES = {
@@ -38,10 +42,18 @@ PLANES = {
     'analogio': 4,
     # 'digitalio': 5, # not working?
 }
+# fixed iteration order for the hot loops in main(), plus a C-level
+# getter that fetches all plane arguments from the Namespace in one call
+_PLANE_ITEMS = tuple(PLANES.items())
+_PLANE_ARGS = attrgetter(*PLANES)
 
 MSR = namedtuple('MSR', ['addr_voltage_offsets', 'addr_units', 'addr_power_limits', 'addr_temp'])
 ADDRESSES = MSR(0x150, 0x606, 0x610, 0x1a2) # Default (Core iX 6th, 7th, 8th, 9th gen etc.)
 
+# registers that live in the package power domain: writing them on one
+# CPU per package is equivalent to writing them everywhere
+PACKAGE_SCOPED_MSRS = frozenset(ADDRESSES)
+
 # 0.2.9 removed --temp-ac flag without warning
 # accept it for now and show deprecation
 # remove in 0.3
@@ -50,37 +62,167 @@ if any('temp-ac' in arg for arg in sys.argv):
     sys.argv = [arg.replace('temp-ac', 'temp') for arg in sys.argv]
 
 
-def valid_cpus():
+MSR_BATCH_NODE = '/dev/cpu/msr_batch'
+
+
+class MsrBatchOp(ctypes.Structure):
     """
-    Get max processor index from multiprocess.count(), then check which
-    values are valid under /dev/cpu/
+    struct msr_batch_op from msr-safe's msr_safe.h
     """
+    _fields_ = [
+        ('cpu', ctypes.c_uint16),
+        ('isrdmsr', ctypes.c_uint16),
+        ('err', ctypes.c_int32),
+        ('msr', ctypes.c_uint32),
+        ('msrdata', ctypes.c_uint64),
+        ('wmask', ctypes.c_uint64),
+    ]
 
-    cpus = []
-    max_cpus = multiprocessing.cpu_count()
-    for i in range(max_cpus):
-        if os.path.isdir("/dev/cpu/%d" % i):
-            cpus.append(i)
 
-    return cpus
+class MsrBatchArray(ctypes.Structure):
+    """
+    struct msr_batch_array from msr-safe's msr_safe.h
+    """
+    _fields_ = [
+        ('numops', ctypes.c_uint32),
+        ('ops', ctypes.POINTER(MsrBatchOp)),
+    ]
 
-def write_msr(val, addr):
+
+# _IOWR('c', 0xA2, struct msr_batch_array)
+X86_IOC_MSR_BATCH = ((3 << 30) | (ctypes.sizeof(MsrBatchArray) << 16) |
+    (ord('c') << 8) | 0xA2)
+
+
+def msr_batch(ops):
+    """
+    Dispatch a list of MsrBatchOp through the msr-safe batch device in a
+    single ioctl, instead of one open/seek/write/close cycle per CPU.
+    Returns the ops array with msrdata filled in for read operations.
+    """
+    batch = (MsrBatchOp * len(ops))(*ops)
+    f = os.open(MSR_BATCH_NODE, os.O_RDWR)
+    try:
+        fcntl.ioctl(f, X86_IOC_MSR_BATCH, MsrBatchArray(len(ops), batch))
+    finally:
+        os.close(f)
+    return batch
+
+
+_MSR_FDS = {}
+
+
+def _msr_fd(cpu):
+    """
+    Return a read/write fd for /dev/cpu/<cpu>/msr, opened once and reused
+    for the lifetime of the process. The msr device supports pread/pwrite,
+    so callers can skip the per-access open/lseek/close cycle.
+    """
+    fd = _MSR_FDS.get(cpu)
+    if fd is None:
+        c = '/dev/cpu/%d/msr' % cpu
+        if not os.path.exists(c):
+            raise OSError("msr module not loaded (run modprobe msr)")
+        fd = _MSR_FDS[cpu] = os.open(c, os.O_RDWR)
+    return fd
+
+
+@atexit.register
+def _close_msr_fds():
+    while _MSR_FDS:
+        os.close(_MSR_FDS.popitem()[1])
+
+
+_CPUS = None
+
+
+def _cpus():
+    """
+    Online CPU indices, parsed once from /sys/devices/system/cpu/online
+    (a single small read of ranges like '0-3,5') and memoized, instead of
+    re-scanning /dev/cpu/ on every MSR write.
+    """
+    global _CPUS
+    if _CPUS is None:
+        with open('/sys/devices/system/cpu/online') as f:
+            online = f.read().strip()
+        cpus = []
+        for part in online.split(','):
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+        _CPUS = tuple(cpus)
+    return _CPUS
+
+
+_PACKAGE_LEADERS = None
+
+
+def _package_leaders():
+    """
+    Lowest CPU index of each physical package, read once from the sysfs
+    topology. The MSRs this tool touches (voltage mailbox, RAPL limits,
+    temperature target) are package-scoped, so writing one CPU per
+    package is enough; falls back to every online CPU if the topology
+    is not exposed.
+    """
+    global _PACKAGE_LEADERS
+    if _PACKAGE_LEADERS is None:
+        packages = {}
+        try:
+            for cpu in _cpus():
+                path = ('/sys/devices/system/cpu/cpu%d/topology/'
+                    'physical_package_id' % cpu)
+                with open(path) as f:
+                    package = int(f.read())
+                if package not in packages or cpu < packages[package]:
+                    packages[package] = cpu
+            _PACKAGE_LEADERS = tuple(sorted(packages.values()))
+        except (IOError, OSError):
+            _PACKAGE_LEADERS = _cpus()
+    return _PACKAGE_LEADERS
+
+
+def valid_cpus():
+    """
+    List of valid CPU indices. Kept for backwards compatibility; simply
+    returns the cached enumeration from _cpus() instead of re-running
+    multiprocessing.cpu_count() plus a stat per CPU on every call.
+    """
+    return list(_cpus())
+
+
+def write_msr(val, addr, cpus=None, wmask=0xFFFFFFFFFFFFFFFF):
     """
     Use /dev/cpu/*/msr interface provided by msr module to read/write
     values from register addr.
-    Writes to all msr node on all CPUs available.
+    Writes to the msr node of each CPU in cpus. By default,
+    package-scoped registers go to one CPU per physical package and
+    anything else to every online CPU.
+    Uses the msr-safe batch device when present, so all CPUs are written
+    in one ioctl rather than one open/seek/write/close cycle each; wmask
+    selects which bits the driver merges on write, so callers owning
+    only part of a register get an atomic read-modify-write. The raw
+    device fallback always writes all 64 bits.
     """
     assert_root()
-    
-    for i in valid_cpus():
-        c = '/dev/cpu/%d/msr' % i
-        if not os.path.exists(c):
-            raise OSError("msr module not loaded (run modprobe msr)")
-        logging.info("Writing {val} to {msr}".format(val=hex(val), msr=c))
-        f = os.open(c, os.O_WRONLY)
-        os.lseek(f, addr, os.SEEK_SET)
-        os.write(f, pack('Q', val))
-        os.close(f)
+
+    if cpus is None:
+        cpus = (_package_leaders() if addr in PACKAGE_SCOPED_MSRS
+            else _cpus())
+
+    if os.path.exists(MSR_BATCH_NODE):
+        logging.info("Writing %#x to %s", val, MSR_BATCH_NODE)
+        msr_batch([
+            MsrBatchOp(cpu, 0, 0, addr, val, wmask)
+            for cpu in cpus])
+        return
+
+    buf = _Q.pack(val)
+    verbose = logging.getLogger().isEnabledFor(logging.INFO)
+    for i in cpus:
+        if verbose:
+            logging.info("Writing %#x to CPU %d", val, i)
+        os.pwrite(_msr_fd(i), buf, addr)
 
 
 def read_msr(addr, cpu=0):
@@ -89,15 +231,25 @@ def read_msr(addr, cpu=0):
     """
     assert_root()
 
-    n = '/dev/cpu/%d/msr' % (cpu,)
-    f = os.open(n, os.O_RDONLY)
-    os.lseek(f, addr, os.SEEK_SET)
-    val, = unpack('Q', os.read(f, 8))
-    logging.info("Read {val} from {n}".format(val=hex(val), n=n))
-    os.close(f)
+    if os.path.exists(MSR_BATCH_NODE):
+        val = msr_batch([MsrBatchOp(cpu, 1, 0, addr, 0, 0)])[0].msrdata
+    else:
+        val, = _Q.unpack(os.pread(_msr_fd(cpu), 8, addr))
+    logging.info("Read %#x from CPU %d", val, cpu)
     return val
 
 
+def _convert_offset_math(mV):
+    # round-half-away-from-zero in pure integer math; mV/1000*1024 never
+    # lands exactly on .5 so this cannot disagree with round() over the
+    # supported domain
+    if mV >= 0:
+        x = int((mV * 1024 + 500) // 1000)
+    else:
+        x = -int((-mV * 1024 + 500) // 1000)
+    return convert_rounded_offset(x)
+
+
 def convert_offset(mV):
     """
     Calculate offset part of MSR value
@@ -108,8 +260,15 @@ def convert_offset(mV):
     >>> format(convert_offset(-50), '08x')
     'f9a00000'
 
+    # Integer rounding agrees with the old round(mV*1.024) formula.
+    >>> all(convert_offset(mV) == convert_rounded_offset(int(round(mV*1.024)))
+    ...     for mV in range(-999, 1000))
+    True
+
     """
-    return convert_rounded_offset(int(round(mV*1.024)))
+    if isinstance(mV, int) and -1000 <= mV <= 1000:
+        return _OFFSET_TBL[mV + 1000]
+    return _convert_offset_math(mV)
 
 
 def unconvert_offset(y):
@@ -122,13 +281,9 @@ def unconvert_offset(y):
     # Test that inverted values give the same output when re-converted.
     # NOTE: domain is [-1000, 1000] - other function, but scaled down by 1.024.
     >>> from undervolt import convert_offset, unconvert_offset
-    >>> for x in range(-999, 1000):
-    ...     y  = convert_offset(x)
-    ...     x2 = unconvert_offset(y)
-    ...     y2 = convert_offset(x2)
-    ...     if y != y2 or x != x2:
-    ...         result = (x, y, x2, y2)
-    ...         assert result
+    >>> regs = [convert_offset(x) for x in range(-999, 1000)]
+    >>> regs == [convert_offset(unconvert_offset(y)) for y in regs]
+    True
     >>> unconvert_offset(0xf0000000)
     -125.0
     >>> unconvert_offset(0xf9a00000)
@@ -137,19 +292,31 @@ def unconvert_offset(y):
     return unconvert_rounded_offset(y) / 1.024
 
 
+# Both rounded conversions have a tiny finite domain (a 12-bit input and
+# an 11-bit register field), so precompute them as lookup tables.
+_CONV_LUT = array('I', (0xFFE00000 & (x << 21) for x in range(4096)))
+_UNCONV_LUT = array('i', (x if x <= 1024 else x - 2048
+    for x in range(2048)))
+
+
 def convert_rounded_offset(x):
-    return 0xFFE00000 & ((x & 0xFFF) << 21)
+    return _CONV_LUT[x & 0xFFF]
 
 
 def unconvert_rounded_offset(y):
     """
     >>> from undervolt import convert_offset, unconvert_offset
     >>> domain = [ 1024 - x for x in range(0, 2048) ]
-    >>> all( x == unconvert_rounded_offset(convert_rounded_offset(x)) for x in domain )
+    >>> domain == [ unconvert_rounded_offset(convert_rounded_offset(x)) for x in domain ]
     True
     """
-    x = y >> 21
-    return x if x <= 1024 else - (2048 - x)
+    return _UNCONV_LUT[(y >> 21) & 0x7FF]
+
+
+# The CLI only ever passes whole millivolts, so convert_offset's integer
+# domain of [-1000, 1000] also fits in one ~8KB table indexed by mV + 1000.
+_OFFSET_TBL = array('I', (_convert_offset_math(mV)
+    for mV in range(-1000, 1001)))
 
 
 def pack_offset(plane_index, offset=None):
@@ -173,8 +340,23 @@ def pack_offset(plane_index, offset=None):
     '8000011000000000'
 
     """
-    return ((1 << 63) | (plane_index << 40) | (1 << 36) |
-        ((offset is not None) << 32) | (offset or 0))
+    # bit 63 (mailbox busy) | bit 36 (offset command), pre-folded; bit 32
+    # selects write and is set together with the offset payload.
+    return (0x8000001000000000 | (plane_index << 40) |
+        ((0x100000000 | (offset & 0xFFFFFFFF)) if offset is not None else 0))
+
+
+# The mailbox words depend only on the plane, so build them once at import
+# instead of re-packing for every read/write. A write word is the plane's
+# prefix OR'd with the 32-bit offset payload.
+_READ_WORDS = dict(
+    (plane, pack_offset(index)) for plane, index in PLANES.items())
+_WRITE_PREFIX = dict(
+    (plane, pack_offset(index, 0)) for plane, index in PLANES.items())
+
+
+# the offset payload lives below the plane index bits
+_MASK_40 = (1 << 40) - 1
 
 
 def unpack_offset(msr_response):
@@ -188,8 +370,7 @@ def unpack_offset(msr_response):
     >>> unpack_offset(0x100f3400000)
     -99.609375
     """
-    plane_index = int(msr_response / (1 << 40))
-    return unconvert_offset(msr_response ^ (plane_index << 40))
+    return unconvert_offset(msr_response & _MASK_40)
 
 
 def read_temperature(msr):
@@ -200,14 +381,43 @@ def set_temperature(temp, msr):
     write_msr((100 - temp) << 24, addr=msr.addr_temp)
 
 
+def read_offset_raw(plane, msr):
+    """
+    Write the 'read' value to mailbox, then re-read the raw 32-bit
+    offset payload
+    """
+    write_msr(_READ_WORDS[plane], msr.addr_voltage_offsets)
+    return read_msr(msr.addr_voltage_offsets) & 0xFFFFFFFF
+
+
 def read_offset(plane, msr):
     """
     Write the 'read' value to mailbox, then re-read
     """
-    plane_index = PLANES[plane]
-    value_to_write = pack_offset(plane_index)
-    write_msr(value_to_write, msr.addr_voltage_offsets)
-    return unpack_offset(read_msr(msr.addr_voltage_offsets))
+    return unconvert_offset(read_offset_raw(plane, msr))
+
+
+def _mailbox_exchange(plane, write_word, addr):
+    """
+    Issue a mailbox write followed by the plane's read request and the
+    read-back, all on CPU 0's cached fd - one short dependency chain
+    instead of three full per-CPU passes.
+    """
+    fd = _msr_fd(0)
+    os.pwrite(fd, _Q.pack(write_word), addr)
+    os.pwrite(fd, _Q.pack(_READ_WORDS[plane]), addr)
+    return _Q.unpack(os.pread(fd, 8, addr))[0]
+
+
+def _broadcast(val, addr):
+    """
+    Write val to the remaining package leaders (CPU 0 has already been
+    handled by _mailbox_exchange).
+    """
+    buf = _Q.pack(val)
+    for cpu in _package_leaders():
+        if cpu != 0:
+            os.pwrite(_msr_fd(cpu), buf, addr)
 
 
 def set_offset(plane, mV, msr):
@@ -215,19 +425,69 @@ def set_offset(plane, mV, msr):
     Set given voltage plane to offset mV
     Raises SystemExit if re-reading value returns something different
     """
-    plane_index = PLANES[plane]
-    logging.info('Setting {plane} offset to {mV}mV'.format(
-        plane=plane, mV=mV))
+    logging.info("Setting %s offset to %smV", plane, mV)
     target = convert_offset(mV)
-    write_value = pack_offset(plane_index, target)
-    write_msr(write_value, msr.addr_voltage_offsets)
-    # now check value set correctly
-    want_mv = unconvert_offset(target)
-    read_mv = read_offset(plane, msr)
-    if want_mv != read_mv:
-        logging.error("Failed to apply {p}: set {t}, read {r}".format(
-            p=plane, t=want_mv, r=read_mv))
+    write_word = _WRITE_PREFIX[plane] | target
+    addr = msr.addr_voltage_offsets
+    batched = os.path.exists(MSR_BATCH_NODE)
+    if batched:
+        write_msr(write_word, addr)
+        read = read_offset_raw(plane, msr)
+    else:
+        assert_root()
+        read = _mailbox_exchange(plane, write_word, addr) & 0xFFFFFFFF
+    # now check value set correctly - compare the raw payloads, which
+    # avoids both string formatting and float equality
+    if read != target:
+        logging.error("Failed to apply %s: set %#x, read %#x",
+            plane, target, read)
         raise SystemExit(1)
+    if not batched:
+        # broadcast the verified word to any other packages
+        _broadcast(write_word, addr)
+
+
+def apply_offsets(offsets, msr):
+    """
+    Set several voltage planes in one go: offsets maps plane name to mV.
+    With msr-safe available, the writes, read requests and read-backs for
+    all planes are queued into a single batch ioctl instead of one full
+    per-CPU pass per operation; otherwise fall back to set_offset per
+    plane. Raises SystemExit if any re-read value differs.
+    """
+    if not os.path.exists(MSR_BATCH_NODE):
+        for plane, mV in offsets.items():
+            set_offset(plane, mV, msr)
+        return
+
+    assert_root()
+    addr = msr.addr_voltage_offsets
+    targets = {}
+    read_slots = {}
+    ops = []
+    for plane, mV in offsets.items():
+        logging.info("Setting %s offset to %smV", plane, mV)
+        targets[plane] = convert_offset(mV)
+        for cpu in _package_leaders():
+            ops.append(MsrBatchOp(cpu, 0, 0, addr,
+                _WRITE_PREFIX[plane] | targets[plane], 0xFFFFFFFFFFFFFFFF))
+        for cpu in _package_leaders():
+            ops.append(MsrBatchOp(cpu, 0, 0, addr,
+                _READ_WORDS[plane], 0xFFFFFFFFFFFFFFFF))
+        read_slots[plane] = len(ops)
+        ops.append(MsrBatchOp(0, 1, 0, addr, 0, 0))
+    done = msr_batch(ops)
+    for plane in offsets:
+        read = done[read_slots[plane]].msrdata & 0xFFFFFFFF
+        if read != targets[plane]:
+            logging.error("Failed to apply %s: set %#x, read %#x",
+                plane, targets[plane], read)
+            raise SystemExit(1)
+
+
+# power-limit register bits this tool does not own (reserved plus the
+# clamp/lock fields handled separately)
+_POWER_LIMIT_RESERVED = 0x7f010000ff010000
 
 
 class PowerLimit:
@@ -241,15 +501,30 @@ class PowerLimit:
     backup_rest=None  # Backup of the bits that are not written
 
 
+_UNITS_CACHE = {}
+
+
+def _get_units(msr):
+    """
+    (power_unit, time_unit) decoded from the RAPL units register. The
+    register is fixed for the life of the boot, so cache the decode and
+    pay for one MSR read no matter how often the limits are touched.
+    """
+    key = msr.addr_units
+    if key not in _UNITS_CACHE:
+        units = read_msr(key)
+        _UNITS_CACHE[key] = (round(2**(units & 0xf)),
+            round(2**((units >> 16) & 0xf)))
+    return _UNITS_CACHE[key]
+
+
 # Author: Stefan Fabian
 # Use at your own risk!
 def read_power_limit(msr):
     def to_seconds(val, unit):
         return 2**(val & 0x1f) * (1 + ((val >> 5) & 0x3) / 4.0) / unit
-    units = read_msr(msr.addr_units)
     val = read_msr(msr.addr_power_limits)
-    power_unit = round(2**(units & 0xf))
-    time_unit = round(2**((units >> 16) & 0xf))
+    power_unit, time_unit = _get_units(msr)
     result = PowerLimit()
     result.short_term_enabled = bool((val >> 47) & 0x1)
     result.short_term_power = ((val >> 32) & 0x7fff) / power_unit
@@ -258,42 +533,47 @@ def read_power_limit(msr):
     result.long_term_power = (val & 0x7fff) / power_unit
     result.long_term_time = to_seconds(val >> 17, time_unit)
     result.locked = bool((val >> 63) & 1)
-    result.backup_rest = val & 0x7f010000ff010000
+    result.backup_rest = val & _POWER_LIMIT_RESERVED
     return result
 
+# the four values of the time window's 2-bit fractional field, and
+# their log2 so from_seconds only takes one logarithm per call
+_PL_MULTIPLIERS = (1.0, 1.25, 1.5, 1.75)
+_PL_LOG2_MULTIPLIERS = tuple(log2(m) for m in _PL_MULTIPLIERS)
+
+
 # Author: Stefan Fabian
 # Use at your own risk!
 def set_power_limit(power_limit, msr):
     def from_seconds(val, unit):
-        # The formula 2^x*(1+y/4) has two variables and can not be solved analytically
-        # y is 2 bytes, hence we only need to check 4 values
+        # The formula 2^x*(1+y/4) has two variables and can not be solved
+        # analytically, but y is only 2 bits: encode all four candidates
+        # and keep the one that rounds back closest to the request.
         val = val * unit
-        if log2(val / 1.75) >= 0x1f:
+        if val <= 0:
+            # log2 would raise; encode the smallest window instead of
+            # crashing on a zero time argument
+            return 0
+        lv = log2(val)
+        if lv - _PL_LOG2_MULTIPLIERS[3] >= 0x1f:
             return 0xfe
-        min_err = 1E9
-        result = 0
-        for y in range(4):
-            multiplier = (1 + y / 4.0)
+        candidates = []
+        for y, multiplier in enumerate(_PL_MULTIPLIERS):
             val_mult = val / multiplier
-            exp = log2(val_mult)
-            exp_int = int(exp)
+            exp_int = int(lv - _PL_LOG2_MULTIPLIERS[y])
             # Due to the logarithm, we can't just round but have to check which one is closer to 2**exp
             if val_mult - 2**exp_int >= 2**(exp_int + 1) - val_mult:
                 exp_int += 1
             if exp_int > 0x1f:
                 exp_int = 0x1f
-            back_val = 2**exp_int * multiplier
-            if abs(back_val - val) < min_err:
-                min_err = abs(back_val - val)
-                result = int(y) << 5 | int(exp_int)
-        return result
+            candidates.append(
+                (abs(2**exp_int * multiplier - val), y << 5 | exp_int))
+        return min(candidates)[1]
     old_limit = read_power_limit(msr)
     if old_limit.locked:
         logging.error("Can not write power limit because it is locked!")
         raise SystemExit(1)
-    units = read_msr(msr.addr_units)
-    power_unit = round(2**(units & 0xf))
-    time_unit = round(2**((units >> 16) & 0xf))
+    power_unit, time_unit = _get_units(msr)
 
     write_value = old_limit.backup_rest
     # short term enabled
@@ -305,7 +585,7 @@ def set_power_limit(power_limit, msr):
         power_limit.short_term_power = old_limit.short_term_power
     short_term_power = int(power_limit.short_term_power * power_unit)
     if short_term_power < 0 or short_term_power > 0x7fff:
-        logging.error("Short term power out of range ({} > 0x7fff)!".format(short_term_power))
+        logging.error("Short term power out of range (%s > 0x7fff)!", short_term_power)
         raise SystemExit(1)
     write_value |= short_term_power << 32
     # short term time
@@ -322,7 +602,7 @@ def set_power_limit(power_limit, msr):
         power_limit.long_term_power = old_limit.long_term_power
     long_term_power = int(power_limit.long_term_power * power_unit)
     if long_term_power < 0 or long_term_power > 0x7fff:
-        logging.error("Long term power out of range ({} > 0x7fff)!".format(long_term_power))
+        logging.error("Long term power out of range (%s > 0x7fff)!", long_term_power)
         raise SystemExit(1)
     write_value |= long_term_power
     # long term time
@@ -335,24 +615,79 @@ def set_power_limit(power_limit, msr):
         power_limit.locked = old_limit.locked
     write_value |= (1 if power_limit.locked else 0) << 63
 
-    # Write the new power limit
-    write_msr(write_value, msr.addr_power_limits)
+    # Write the new power limit; with msr-safe, the write mask makes the
+    # driver merge only the fields we computed, so the reserved bits
+    # cannot race against whatever changed them since the read above
+    write_msr(write_value, msr.addr_power_limits,
+        wmask=_POWER_LIMIT_RESERVED ^ 0xFFFFFFFFFFFFFFFF)
     val = read_msr(msr.addr_power_limits)
-    if val != write_value:
-        logging.error("Failed to apply power limit: Tried to set {}, read {}".format(write_value, val))
+    # only compare the fields we own: with the masked write the driver
+    # keeps the live reserved bits, which may legitimately differ from
+    # the backup_rest snapshot taken above
+    if (val ^ write_value) & ~_POWER_LIMIT_RESERVED:
+        logging.error("Failed to apply power limit: Tried to set %s, read %s", write_value, val)
         raise SystemExit(1)
 
 
 
+def read_throttlestop(path, profile):
+    """
+    Extract the FIVR voltage values for the given profile index from a
+    ThrottleStop.ini in one regex pass over the file, which is much
+    cheaper than a full configparser parse just to fetch a handful of
+    keys. Returns a dict mapping plane index to the raw register value.
+    """
+    with open(path) as f:
+        text = f.read()
+    values = {}
+    for plane, prof, value in re.findall(
+            r'FIVRVoltage(\d)(\d+)=(\S+)', text):
+        if int(prof) == profile:
+            values[int(plane)] = int(value, 16)
+    return values
+
+
+@functools.lru_cache(maxsize=1)
 def read_ac_state():
     """
-    Returns True if AC is connected, else False
+    Returns True if AC is connected, else False.
+    Cached: main() may consult it for both --temp and --temp-bat, and
+    the answer cannot meaningfully change within one run.
     """
     if AC_STATE_NODE:
-        return open(AC_STATE_NODE).read() == '1\n'
+        fd = os.open(AC_STATE_NODE, os.O_RDONLY)
+        try:
+            return os.read(fd, 2)[:1] == b'1'
+        finally:
+            os.close(fd)
     # Assume no battery if the /sys entry is missing.
     return True
 
+def _load_msr_module():
+    """
+    Load the msr kernel module. Try the finit_module syscall on msr.ko
+    directly to avoid a fork+exec, and fall back to spawning modprobe
+    (which also copes with compressed modules) when that fails.
+    """
+    # syscall numbers are per-architecture: 313 is finit_module only on
+    # x86_64 (on 32-bit x86 it is splice), so take the fast path only
+    # from a 64-bit interpreter on an x86_64 kernel
+    if (os.uname().machine == 'x86_64'
+            and ctypes.sizeof(ctypes.c_void_p) == 8):
+        try:
+            fd = os.open('/lib/modules/%s/kernel/arch/x86/kernel/msr.ko'
+                % os.uname().release, os.O_RDONLY)
+            try:
+                if ctypes.CDLL(None, use_errno=True).syscall(
+                        313, fd, b'', 0) == 0:
+                    return
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+    subprocess.check_call(['modprobe', 'msr'])
+
+
 def assert_root():
     """
     Checks whether the user has root privileges, exit otherwise
@@ -394,8 +729,9 @@ def main():
     
     msr = ADDRESSES
 
-    if not glob('/dev/cpu/*/msr'):
-        subprocess.check_call(['modprobe', 'msr'])
+    # one stat instead of a directory scan when the module is loaded
+    if not os.path.exists('/dev/cpu/0/msr'):
+        _load_msr_module()
 
     if (args.core or args.cache) and args.core != args.cache:
         logging.warning(
@@ -404,13 +740,15 @@ def main():
         )
 
     # for each arg, try to set voltage
-    for plane in PLANES:
-        offset = getattr(args, plane)
+    offsets = {}
+    for (plane, index), offset in zip(_PLANE_ITEMS, _PLANE_ARGS(args)):
         if offset is None:
             continue
         if offset > 0 and not args.force:
             raise ValueError("Use --force to set positive offset")
-        set_offset(plane, offset, msr)
+        offsets[plane] = offset
+    if offsets:
+        apply_offsets(offsets, msr)
 
     if (args.temp and read_ac_state()) or (args.temp and not args.temp_bat):
         set_temperature(args.temp, msr)
@@ -435,13 +773,9 @@ def main():
     throttlestop = getattr(args, 'throttlestop')
     if throttlestop is not None:
         command = 'undervolt'
-        tsindex = getattr(args, 'tsindex')
-        config = configparser.ConfigParser()
-        config.read(throttlestop)
-        for plane in PLANES:
-            hex_str = config.get('ThrottleStop', 'FIVRVoltage{plane}{profile}'.format(
-                plane=PLANES[plane], profile=tsindex))
-            hex_value = int(hex_str, 16)
+        voltages = read_throttlestop(throttlestop, getattr(args, 'tsindex'))
+        for plane, index in _PLANE_ITEMS:
+            hex_value = voltages[index]
             if hex_value != 0:
                 offset = unconvert_offset(hex_value)
                 command += ' --{plane} {offset}'.format(plane=plane, offset=offset)
@@ -453,7 +787,7 @@ def main():
             tjunc=temp,
             temp=100 - temp
         ))
-        for plane in PLANES:
+        for plane, index in _PLANE_ITEMS:
             voltage = read_offset(plane, msr)
             print('{plane}: {voltage} mV'.format(
                 plane=plane, voltage=round(voltage, 2)))